@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 from configparser import ConfigParser
+from functools import lru_cache
 from pathlib import Path
 import argparse
+import asyncio
+import os
 import sys
 import logging
 import subprocess
@@ -19,10 +22,14 @@ def notify(message):
 
 LAST_UPDATE_FILE = Path("/var/tmp/gitupdater.lock")
 
-
-def setup_logging(verbose=False):
+# colorize level names once, and only when stderr is a terminal so that
+# piped or journald output doesn't carry raw escape sequences
+if sys.stderr.isatty():
     logging.addLevelName(logging.ERROR, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
     logging.addLevelName(logging.WARNING, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+
+
+def setup_logging(verbose=False):
     level = getattr(logging, 'DEBUG' if verbose else 'INFO')
     logging.basicConfig(
         level=level,
@@ -30,18 +37,57 @@ def setup_logging(verbose=False):
     )
 
 
-def parse_interval_sec(string):
-    units = {
-        "s": 1,
-        "m": 60,
-        "h": 3600,
-        "d": 86400,
-    }
+INTERVAL_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+    "d": 86400,
+}
 
-    for suffix, value in units.items():
-        if string.endswith(suffix):
-            prefix = float(string.split(suffix)[0])
-            return int(prefix * value)
+
+@lru_cache(maxsize=64)
+def parse_interval_sec(string):
+    value = INTERVAL_UNITS.get(string[-1:])
+    if value is not None:
+        return int(float(string[:-1]) * value)
+
+
+class RepoProc:
+    """Long-lived `git cat-file --batch-check` child for one repository.
+
+    git process startup dominates the cost of small probes; spawning the
+    helper once per repo and piping queries makes every probe after the
+    first a single pipe round-trip.
+    """
+
+    def __init__(self, path):
+        self.proc = subprocess.Popen(
+            ["git", "-C", str(path), "cat-file", "--batch-check"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def check(self, name):
+        """Return the batch-check line for name, or None if git refused to start."""
+        try:
+            self.proc.stdin.write(f"{name}\n")
+            self.proc.stdin.flush()
+            return self.proc.stdout.readline().strip() or None
+        except (BrokenPipeError, OSError, ValueError):
+            return None
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
 
 class GitUpdater:
@@ -49,58 +95,197 @@ class GitUpdater:
         self.args = args
         self.config = config
         self.load_default()
+        self._ignore_untracked = config["DEFAULT"].getboolean("ignore_untracked_files", False)
+        self._use_maintenance = config["DEFAULT"].getboolean("maintenance_prefetch", False)
+        self._env = self.build_env()
+        self._paths = {s: Path(config[s]["path"]).expanduser() for s in config.sections()}
+        self._path_strs = {s: str(p) for s, p in self._paths.items()}
+        # the same argvs are reissued every run; build them once per section,
+        # with the untracked-files flag baked in rather than appended per call
+        status_extra = ("--untracked-files=no",) if self._ignore_untracked else ()
+        self._argv_status = {s: ("git", "-C", p, "status", "--porcelain") + status_extra for s, p in self._path_strs.items()}
+        self._argv_pull = {s: ("git", "-C", p, "pull", "--rebase") for s, p in self._path_strs.items()}
+        self._section_dirs = self.scan_section_dirs()
+        self._repo_procs = {}
+        tasks = []
         for section in config.sections():
             section_dict = dict(config[section])
             if section_dict:
                 logging.debug(f"[{section}]\n{section_dict}")
-            self.process_section(config[section])
+            tasks.append((section, self.process_section(config[section])))
+        asyncio.run(self._run(tasks))
+
+    async def _run(self, tasks):
+        if self._use_maintenance:
+            await self.maintenance_prefetch()
+        sem = asyncio.Semaphore(self.args.max_concurrent)
+
+        async def bounded(name, task):
+            # sections are independent: log a failed one and let the
+            # rest finish instead of cancelling them mid-operation
+            async with sem:
+                try:
+                    await task
+                except (subprocess.CalledProcessError, OSError) as e:
+                    logging.error(f"[{name}] failed: {e}")
+
+        await asyncio.gather(*(bounded(name, task) for name, task in tasks))
 
     def load_default(self):
-        update_interval = parse_interval_sec(self.config["DEFAULT"].get("update_interval", "5m"))
-        if not LAST_UPDATE_FILE.exists():
-            LAST_UPDATE_FILE.touch()
-        else:
+        self._update_interval = update_interval = parse_interval_sec(self.config["DEFAULT"].get("update_interval", "5m"))
+        try:
             last_date = LAST_UPDATE_FILE.stat().st_mtime
-            elapsed = time.time() - last_date
-            if elapsed < update_interval and not self.args.create:
-                logging.debug(f"Only {int(elapsed)}s elapsed, not attempting update before {update_interval}s")
-                sys.exit(0)
-            else:
-                LAST_UPDATE_FILE.touch()
-
-    def process_section(self, section):
-        git_path = Path(section["path"]).expanduser()
-        if not git_path.exists() or not self.git_folder_is_repo(git_path):
-            if not args.create:
+        except FileNotFoundError:
+            LAST_UPDATE_FILE.open("w").close()
+            return
+        elapsed = time.time() - last_date
+        if elapsed < update_interval and not self.args.create:
+            logging.debug(f"Only {int(elapsed)}s elapsed, not attempting update before {update_interval}s")
+            sys.exit(0)
+        os.utime(LAST_UPDATE_FILE, None)
+
+    async def maintenance_register(self, name):
+        await self.run_cmd(("git", "-C", self._path_strs[name], "maintenance", "register"))
+
+    async def maintenance_prefetch(self):
+        # one git process fetches every registered repo with its own
+        # internal parallelism, so the per-section pulls that follow only
+        # fast-forward from objects already in the local store
+        argv = ("git", "for-each-repo", "--config=maintenance.repo", "maintenance", "run", "--task=prefetch")
+        try:
+            await self.run_cmd(argv)
+        except subprocess.CalledProcessError as e:
+            logging.warning(f"Batched prefetch failed with code {e.returncode}")
+
+    def build_env(self):
+        # multiplex SSH connections over a control socket so sections
+        # pulling from the same host only pay one handshake per run
+        env = {**os.environ, "LANG": "C"}
+        if "GIT_SSH_COMMAND" not in env:
+            cache_dir = Path("~/.cache/gitupdater").expanduser()
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            env["GIT_SSH_COMMAND"] = (
+                f"ssh -o ControlMaster=auto -o ControlPath={cache_dir}/ssh-%C -o ControlPersist=60"
+            )
+        return env
+
+    def scan_section_dirs(self):
+        # Sections often share a parent directory (e.g. ~/src/*): one
+        # scandir per parent answers existence for all of its sections,
+        # instead of a stat per section path.
+        parents = {}
+        for path in self._paths.values():
+            parents.setdefault(path.parent, {})[path.name] = None
+        for parent, names in parents.items():
+            try:
+                with os.scandir(parent) as entries:
+                    for entry in entries:
+                        if entry.name in names:
+                            names[entry.name] = entry
+            except OSError:
+                # a missing, unreadable or non-directory parent degrades
+                # to the per-section "does not exist" warning
+                pass
+        return parents
+
+    async def process_section(self, section):
+        git_path = self._paths[section.name]
+        entry = self._section_dirs.get(git_path.parent, {}).get(git_path.name)
+        if entry is None or not await self.git_folder_is_repo(git_path):
+            if not self.args.create:
                 logging.warning(f"Path {git_path} does not exist, run with --create to checkout (missing folders will be created)")
             else:
-                self.git_checkout(section["url"], git_path)
+                await self.git_checkout(section, git_path)
+                if self._use_maintenance:
+                    await self.maintenance_register(section.name)
         else:
+            if self._use_maintenance and self.args.create:
+                await self.maintenance_register(section.name)
             if section.getboolean("auto_update", False):
-                if self.git_has_changes(git_path, self.config["DEFAULT"].getboolean("ignore_untracked_files", False)):
+                if await self.git_has_changes(section.name):
                     logging.warning(f"Path {git_path} has uncommited changes, skipping")
                 else:
-                    self.git_pull(git_path)
-
-    def git_folder_is_repo(self, path):
-        cmd = f"git -C {path} rev-parse"
-        try:
-            self.run_cmd(cmd, is_safe=True)
+                    await self.git_pull(section.name)
+
+    async def git_folder_is_repo(self, path):
+        # A couple of stat calls answer this for the common layouts
+        # (worktree with a .git dir, worktree/submodule with a gitdir
+        # pointer file, bare repo); only ask git itself when in doubt.
+        git_dir = path / ".git"
+        if git_dir.is_dir() or (path / "HEAD").is_file():
             return True
-        except subprocess.CalledProcessError:
-            return False
-
-    def git_pull(self, path):
+        if git_dir.is_file():
+            return git_dir.read_bytes()[:7] == b"gitdir:"
+        return self.repo_proc(path).check("HEAD") is not None
+
+    def repo_proc(self, path):
+        proc = self._repo_procs.get(path)
+        if proc is None:
+            proc = self._repo_procs[path] = RepoProc(path)
+        return proc
+
+    def git_dir(self, path):
+        # resolve the real git dir when .git is a gitdir pointer file
+        # (linked worktree, submodule checkout)
+        git_dir = path / ".git"
+        if git_dir.is_file():
+            try:
+                pointer = git_dir.read_text()
+            except OSError:
+                return git_dir
+            if pointer.startswith("gitdir:"):
+                target = Path(pointer[7:].strip())
+                if not target.is_absolute():
+                    target = path / target
+                return target
+        return git_dir
+
+    async def git_pull(self, name):
+        # A stamp file written after each successful pull records when
+        # this repo was last integrated; skip the network call while it
+        # is younger than the update interval. FETCH_HEAD is no good as
+        # a freshness signal: external fetches (IDE autofetch, git
+        # maintenance) bump it without updating the worktree.
+        path = self._paths[name]
+        stamp = self.git_dir(path) / "gitupdater.stamp"
+        try:
+            elapsed = time.time() - stamp.stat().st_mtime
+        except OSError:
+            elapsed = None
+        if elapsed is not None and self._update_interval and elapsed < self._update_interval:
+            logging.debug(f"{path} pulled {int(elapsed)}s ago, not pulling again")
+            return
         logging.debug(f"Updating {path}")
-        cmd = f"git -C {path} pull --rebase"
-        if self.run_cmd(cmd) != "Already up to date.":
+        output = await self.run_cmd(self._argv_pull[name])
+        if not self.args.dry_run:
+            try:
+                os.utime(stamp, None)
+            except FileNotFoundError:
+                try:
+                    stamp.open("w").close()
+                except OSError:
+                    pass
+            except OSError:
+                pass
+        if output != b"Already up to date.":
             msg = f"{path} updated"
             logging.info(msg)
             if self.args.notify:
                 notify(msg)
 
-    def git_checkout(self, git_url, path):
-        cmd = f"git clone {git_url} {path}"
+    async def git_checkout(self, section, path):
+        git_url = section["url"]
+        argv = ["git", "clone"]
+        if section.getboolean("shallow", False):
+            argv += ["--depth=1", "--single-branch"]
+        clone_filter = section.get("filter", "")
+        if clone_filter:
+            argv.append(f"--filter={clone_filter}")
+        if section.getboolean("recurse_submodules", False):
+            argv.append("--recurse-submodules")
+        # parallelize submodule clones inside the single git process
+        argv += ["--jobs", str(os.cpu_count() or 4)]
+        argv += [git_url, str(path)]
 
         if not self.args.dry_run and not path.is_dir():
             logging.debug(f"Creating path {path}")
@@ -109,27 +294,54 @@ class GitUpdater:
             logging.info(f"Dry run: not creating path {path}")
 
         logging.info(f"Checking out {git_url} into {path}")
-        self.run_cmd(cmd)
-
-    def git_has_changes(self, path, ignore_untracked_files=False):
-        cmd = f"git -C {path} status --porcelain"
-        if ignore_untracked_files:
-            cmd += " --untracked-files=no"
-        output = self.run_cmd(cmd, is_safe=True)
-        if output:
-            return True
-
-    def run_cmd(self, cmd, is_safe=False):
-        cmd = f"LANG=C {cmd}"
+        await self.run_cmd(argv)
+
+    async def git_has_changes(self, name):
+        # Only "is there any change?" matters, so read a single byte of
+        # status output and kill the child instead of collecting the full
+        # report, which can be large on big dirty worktrees.
+        argv = self._argv_status[name]
+        logging.debug(f"Running {argv}")
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            env=self._env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        first = await proc.stdout.read(1)
+        if first:
+            # dirty: stop git early instead of draining the full report;
+            # the short grace period lets small repos exit on their own
+            # without tripping the child watcher
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), 0.05)
+            except asyncio.TimeoutError:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    pass
+        await proc.wait()
+        return bool(first)
+
+    async def run_cmd(self, argv, is_safe=False):
         if not self.args.dry_run or is_safe:
-            logging.debug(f"Running {cmd}")
-            if not self.args.verbose:
-                output = subprocess.check_output(cmd, shell=True, text=True, stderr=subprocess.DEVNULL)
-            else:
-                output = subprocess.check_output(cmd, shell=True, text=True)
+            logging.debug(f"Running {argv}")
+            stderr = None if self.args.verbose else asyncio.subprocess.DEVNULL
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                env=self._env,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=stderr,
+            )
+            output, _ = await proc.communicate()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, argv, output=output)
+            # stay in bytes: callers only test truthiness or compare
+            # against ASCII literals, so decoding the output would be a
+            # wasted codec pass
             return output.strip()
         else:
-            logging.info(f"Dry run: not running {cmd}")
+            logging.info(f"Dry run: not running {argv}")
 
 
 if __name__ == '__main__':
@@ -167,16 +379,42 @@ if __name__ == '__main__':
         action="store_true"
     )
 
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=max(1, (os.cpu_count() or 4) * 3 // 4),
+        help="Maximum number of repositories processed in parallel"
+    )
+
     args = parser.parse_args()
     setup_logging(args.verbose)
 
     home = Path.home()
-    config_files = args.config or [home / ".config/gitupdater"] + list(home.glob(".config/gitupdater.d/*"))
+    if args.config:
+        config_files = [Path(args.config)]
+    else:
+        try:
+            with os.scandir(home / ".config/gitupdater.d") as entries:
+                dropins = [Path(e.path) for e in entries if e.is_file(follow_symlinks=False)]
+        except FileNotFoundError:
+            dropins = []
+        config_files = [home / ".config/gitupdater"] + sorted(dropins)
 
     if args.verbose:
         logging.debug(f"Sourcing config file(s) {config_files}")
 
-    config = ConfigParser()
+    # strict=False keeps read()'s merge semantics: a section or key
+    # redefined in a drop-in overrides the earlier value instead of
+    # raising DuplicateSectionError on the concatenated text
+    config = ConfigParser(strict=False)
 
-    config.read(config_files)
+    # concatenate the files and parse once instead of re-entering the
+    # parser per drop-in file
+    texts = []
+    for config_file in config_files:
+        try:
+            texts.append(config_file.read_text())
+        except OSError:
+            pass
+    config.read_string("\n".join(texts))
     gitupdater = GitUpdater(args, config)